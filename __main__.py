@@ -28,9 +28,13 @@ def main():
     if args.api_key:
         os.environ["ANTHROPIC_API_KEY"] = args.api_key
     
-    # Fix the import to use direct import instead of package import
-    from app import main as app_main
-    app_main()
+    # Run the Streamlit server in this process; this behaves the same on every
+    # OS, unlike os.exec*, which spawns a detached child on Windows
+    from streamlit.web import cli
+    
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    sys.argv = ["streamlit", "run", app_path]
+    sys.exit(cli.main())
     
 if __name__ == "__main__":
     main() 
\ No newline at end of file
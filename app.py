@@ -1,16 +1,99 @@
 """
 Streamlit app for the computer use demo.
 """
+import atexit
+import json
+import logging
 import os
+import shutil
+import tempfile
 import time
-from typing import List, Dict, Any, Optional
+import traceback
+from collections import deque
+from typing import TYPE_CHECKING, Any, Dict, Iterable
 
 import streamlit as st
-from PIL import Image
-import io
-import base64
 
-from loop import AgentLoop
+if TYPE_CHECKING:
+    import anthropic
+
+    from loop import AgentLoop
+
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of chat messages kept in session state and redrawn per rerun
+MAX_CHAT_MESSAGES = 200
+
+# Session screenshot directories untouched for this long (in seconds) are
+# treated as abandoned and removed
+SCREENSHOT_MAX_AGE = 24 * 60 * 60
+
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key: str) -> "anthropic.Anthropic":
+    """
+    Get an Anthropic client shared across reruns and sessions.
+
+    The client owns the HTTP connection pool, so reusing it avoids a new
+    TLS handshake every time a session creates its agent.
+
+    Args:
+        api_key: Anthropic API key
+
+    Returns:
+        Cached Anthropic client for the key
+    """
+    import anthropic
+
+    return anthropic.Anthropic(api_key=api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def get_screenshot_root() -> str:
+    """
+    Get the process-wide directory that holds each session's screenshots.
+
+    Returns:
+        Path to the screenshot root directory, removed when the server exits
+    """
+    root = tempfile.mkdtemp(prefix="computer-use-demo-")
+    atexit.register(shutil.rmtree, root, ignore_errors=True)
+    return root
+
+
+def _prune_screenshot_dirs(root: str):
+    """
+    Remove session screenshot directories that have not been written to
+    within SCREENSHOT_MAX_AGE.
+
+    Args:
+        root: Screenshot root directory
+    """
+    cutoff = time.time() - SCREENSHOT_MAX_AGE
+    for entry in os.scandir(root):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            logger.debug("Could not check screenshot directory: %s", entry.path)
+
+
+def create_agent(api_key: str) -> "AgentLoop":
+    """
+    Create an agent loop for the current session using the shared client.
+
+    Args:
+        api_key: Anthropic API key
+
+    Returns:
+        New agent loop with its own conversation history
+    """
+    # Imported here so a first paint without an API key does not load the
+    # Anthropic SDK and the screenshot tooling
+    from loop import AgentLoop
+
+    return AgentLoop(api_key=api_key, client=get_client(api_key))
 
 
 def init_session_state():
@@ -18,7 +101,7 @@ def init_session_state():
     Initialize session state variables.
     """
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        st.session_state.messages = deque(maxlen=MAX_CHAT_MESSAGES)
         
     if "agent" not in st.session_state:
         # Check for API key
@@ -26,28 +109,77 @@ def init_session_state():
         if not api_key:
             st.session_state.agent = None
         else:
-            st.session_state.agent = AgentLoop(api_key=api_key)
+            st.session_state.agent = create_agent(api_key)
             
     if "screenshot" not in st.session_state:
         st.session_state.screenshot = None
         
+    if "screenshot_dir" not in st.session_state:
+        # Created on the first screenshot, so sessions without any leave no trace
+        st.session_state.screenshot_dir = None
+        st.session_state.screenshot_count = 0
+        
     if "is_waiting" not in st.session_state:
         st.session_state.is_waiting = False
 
 
+def save_screenshot(png_bytes: bytes) -> str:
+    """
+    Write a screenshot into the session's screenshot directory.
+
+    Keeping only the file path in session state avoids holding (and
+    re-sending to the browser) the image payload on every rerun.
+
+    Args:
+        png_bytes: PNG image data
+
+    Returns:
+        Path to the written PNG file
+    """
+    if st.session_state.screenshot_dir is None:
+        # Sessions have no end hook, so abandoned sessions' screenshots are
+        # cleared out whenever another session starts saving
+        root = get_screenshot_root()
+        _prune_screenshot_dirs(root)
+        st.session_state.screenshot_dir = tempfile.mkdtemp(dir=root)
+    
+    # The counter keeps names unique for captures within the same second
+    st.session_state.screenshot_count += 1
+    filename = f"screenshot_{time.strftime('%Y%m%d_%H%M%S')}_{st.session_state.screenshot_count:06d}.png"
+    path = os.path.join(st.session_state.screenshot_dir, filename)
+    with open(path, "wb") as f:
+        f.write(png_bytes)
+    return path
+
+
+def delete_screenshots(messages: Iterable[Dict[str, Any]]):
+    """
+    Delete the screenshot files referenced by chat messages.
+
+    Args:
+        messages: Messages that are no longer shown in the chat
+    """
+    for message in messages:
+        path = message.get("screenshot")
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                logger.debug("Could not remove screenshot: %s", path)
+
+
 def display_messages():
     """
     Display all messages in the chat.
     """
     # Debug all message types for troubleshooting
-    print("Current message history:")
-    for i, message in enumerate(st.session_state.messages):
-        print(f"Message {i}: role={message.get('role')}, keys={list(message.keys())}")
-        if "tool_calls" in message:
-            print(f"  Tool calls: {message['tool_calls']}")
-        if "tool_call" in message:
-            print(f"  Tool call: {message['tool_call']}")
-            
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Current message history:")
+        for i, message in enumerate(st.session_state.messages):
+            logger.debug("Message %d: role=%s, keys=%s", i, message.get("role"), list(message))
+            if "tool_calls" in message:
+                logger.debug("  Tool calls: %s", message["tool_calls"])
+
     # Display messages in the UI
     for message in st.session_state.messages:
         role = message["role"]
@@ -59,9 +191,8 @@ def display_messages():
             with st.chat_message("assistant"):
                 st.write(content)
                 # Check if this assistant message contains tool calls
-                if "tool_calls" in message and message["tool_calls"]:
-                    tool_calls = message["tool_calls"]
-                    st.write(f"*Using tool: {tool_calls[0]['name']}*")
+                if message.get("tool_calls"):
+                    st.write(f"*Using tool: {', '.join(message['tool_calls'])}*")
         elif role == "tool":
             with st.chat_message("system", avatar="🔧"):
                 st.write(f"Tool response: {content}")
@@ -72,16 +203,12 @@ def display_messages():
                 # Display screenshot if available
                 if "screenshot" in message:
                     try:
-                        screenshot_data = message["screenshot"]
-                        # Debug information about the screenshot
-                        st.write(f"Screenshot data length: {len(screenshot_data)} chars")
-                        
-                        if screenshot_data.startswith("data:image/png;base64,"):
-                            st.image(screenshot_data, caption="Screenshot", use_column_width=True)
+                        screenshot_path = message["screenshot"]
+                        if os.path.isfile(screenshot_path):
+                            st.image(screenshot_path, caption="Screenshot", use_column_width=True)
                         else:
-                            st.error("Invalid screenshot data format")
+                            st.error(f"Screenshot file not found: {screenshot_path}")
                     except Exception as e:
-                        import traceback
                         st.error(f"Error displaying screenshot: {str(e)}")
                         st.code(traceback.format_exc())
 
@@ -100,21 +227,31 @@ def process_message(user_input: str):
         })
         return
         
-    # Add user message to history
-    st.session_state.messages.append({
+    # Collect this turn's messages locally and add them to session state once
+    new_messages = [{
         "role": "user",
         "content": user_input
-    })
+    }]
     
     # Set waiting state for UI
     st.session_state.is_waiting = True
     
+    # The agent exists, so loop is already imported
+    from loop import serialize_result
+    
     try:
-        # Run the agent
-        response, tool_calls = st.session_state.agent.run(user_input)
+        # Show the new user message, then stream the agent's reply under it
+        agent = st.session_state.agent
+        st.chat_message("user").write(user_input)
+        with st.chat_message("assistant"):
+            st.write_stream(agent.run_stream(user_input))
+        response, tool_calls = agent.last_response, agent.last_tool_calls
         
-        # Process tool calls
+        # Process tool calls; a repeated call the agent only ran once has
+        # already been shown through the original
         for call in tool_calls:
+            if call.get("duplicate_of"):
+                continue
             tool_name = call["name"]
             args = call["args"]
             result = call["result"]
@@ -122,55 +259,102 @@ def process_message(user_input: str):
             # Handle screenshots from computer tool
             if tool_name == "computer" and args.get("action") == "screenshot":
                 # Debug information
-                st.session_state.messages.append({
+                new_messages.append({
                     "role": "system",
-                    "content": f"Debug - Screenshot result: Success={result.get('success')}, Data length: {len(result.get('screenshot', ''))} chars"
+                    "content": f"Debug - Screenshot result: Success={result.get('success')}, Data length: {len(result.get('screenshot') or b'')} bytes"
                 })
                 
                 if result.get("success"):
                     # Extract and save the screenshot
-                    screenshot_data = result.get("screenshot", "")
-                    if screenshot_data and isinstance(screenshot_data, str) and screenshot_data.startswith("data:image/png;base64,"):
-                        # Add system message with screenshot
-                        st.session_state.messages.append({
+                    png_bytes = result.get("screenshot")
+                    if isinstance(png_bytes, bytes):
+                        # Add system message with the saved screenshot path
+                        new_messages.append({
                             "role": "system",
                             "content": "Screenshot captured",
-                            "screenshot": screenshot_data
+                            "screenshot": save_screenshot(png_bytes)
                         })
                     else:
-                        st.session_state.messages.append({
+                        new_messages.append({
                             "role": "system",
-                            "content": f"Screenshot data invalid: {screenshot_data[:100]}..."
+                            "content": "Screenshot data invalid: expected PNG bytes"
                         })
                 else:
-                    st.session_state.messages.append({
+                    new_messages.append({
                         "role": "system",
                         "content": f"Screenshot failed: {result.get('message', 'Unknown error')}"
                     })
             else:
                 # Add system message for other tool calls
-                st.session_state.messages.append({
+                new_messages.append({
                     "role": "system",
-                    "content": f"Tool: {tool_name}\nArgs: {args}\nResult: {result}"
+                    "content": "Tool: {}\nArgs: {}\nResult: {}".format(
+                        tool_name,
+                        json.dumps(args, separators=(",", ":"), default=str),
+                        serialize_result(result),
+                    )
                 })
         
-        # Add assistant response to history
-        st.session_state.messages.append({
+        # Add assistant response to history, with the tool names deduplicated
+        # once here rather than on every rerun
+        new_messages.append({
             "role": "assistant",
-            "content": response
+            "content": response,
+            "tool_calls": sorted({call["name"] for call in tool_calls if call.get("name")}),
         })
     except Exception as e:
         # Handle errors
-        import traceback
-        st.session_state.messages.append({
+        new_messages.append({
             "role": "system",
             "content": f"Error: {str(e)}\n{traceback.format_exc()}"
         })
     finally:
+        # The deque drops its oldest messages to make room; remove their
+        # screenshots from disk as well
+        messages = st.session_state.messages
+        overflow = len(messages) + len(new_messages) - messages.maxlen
+        if overflow > 0:
+            delete_screenshots(list(messages)[:overflow])
+        messages.extend(new_messages)
         # Reset waiting state
         st.session_state.is_waiting = False
 
 
+@st.fragment
+def render_sidebar():
+    """
+    Render the sidebar configuration controls.
+
+    Runs as a fragment so typing in the API key field or pressing Apply only
+    reruns the sidebar instead of redrawing the whole chat history.
+    """
+    st.header("Configuration")
+    api_key = st.text_input("Anthropic API Key", 
+                           type="password", 
+                           value=os.environ.get("ANTHROPIC_API_KEY", ""),
+                           help="Enter your Anthropic API Key to enable Claude interaction")
+    
+    if st.button("Apply API Key"):
+        if api_key:
+            os.environ["ANTHROPIC_API_KEY"] = api_key
+            # Keep the current agent (and its conversation) if the key is unchanged
+            agent = st.session_state.agent
+            if agent is None or agent.api_key != api_key:
+                st.session_state.agent = create_agent(api_key)
+            st.success("API key applied!")
+        else:
+            st.error("Please enter an API key")
+            
+    if st.button("Clear Chat"):
+        st.session_state.messages = deque(maxlen=MAX_CHAT_MESSAGES)
+        st.session_state.screenshot = None
+        if st.session_state.screenshot_dir is not None:
+            shutil.rmtree(st.session_state.screenshot_dir, ignore_errors=True)
+            st.session_state.screenshot_dir = None
+        # Full app rerun so the chat area is cleared too
+        st.rerun(scope="app")
+
+
 def main():
     """
     Main function for the Streamlit app.
@@ -194,24 +378,7 @@ def main():
     
     # API Key input
     with st.sidebar:
-        st.header("Configuration")
-        api_key = st.text_input("Anthropic API Key", 
-                               type="password", 
-                               value=os.environ.get("ANTHROPIC_API_KEY", ""),
-                               help="Enter your Anthropic API Key to enable Claude interaction")
-        
-        if st.button("Apply API Key"):
-            if api_key:
-                os.environ["ANTHROPIC_API_KEY"] = api_key
-                st.session_state.agent = AgentLoop(api_key=api_key)
-                st.success("API key applied!")
-            else:
-                st.error("Please enter an API key")
-                
-        if st.button("Clear Chat"):
-            st.session_state.messages = []
-            st.session_state.screenshot = None
-            st.rerun()
+        render_sidebar()
     
     # Main chat interface
     display_messages()
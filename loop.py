@@ -2,50 +2,58 @@
 Agent loop implementation.
 """
 import json
+import logging
 import os
-from typing import Any, Dict, List, Optional, Tuple, TypedDict, Literal
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import anthropic
-from anthropic.types import Message, MessageParam
+from anthropic.types import Message
 
-from tools import Tool as BaseTool
 from tools.computer import ComputerTool
 
-# Define our own Tool class since it's not in the latest SDK
-class ToolParameter(TypedDict):
-    type: str
-    description: Optional[str]
-    enum: Optional[List[str]]
-    
-class ToolParameterProperties(TypedDict):
-    type: str
-    properties: Dict[str, ToolParameter]
-    required: Optional[List[str]]
+logger = logging.getLogger(__name__)
+
+# Prompt caching breakpoint for stable prefixes (tools, system, past turns)
+_CACHE_CONTROL = {"type": "ephemeral"}
+
+# Read-only (tool name, action) calls that may share one result when a
+# response repeats them; anything with side effects must run every time
+_SAFE_TO_DEDUP = {("computer", "screenshot")}
+
+# Upper bound on tools run concurrently for a single response
+_MAX_TOOL_WORKERS = 8
 
-class Tool(TypedDict):
-    name: str
-    description: str
-    input_schema: ToolParameterProperties
 
 class AgentLoop:
     """
     Agent loop for the computer use demo.
     """
 
-    def __init__(self, api_key: Optional[str] = None, model: str = "claude-3-opus-20240229"):
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model: str = "claude-3-opus-20240229",
+        client: Optional[anthropic.Anthropic] = None,
+        max_turns: int = 10,
+        parallel_tools: bool = True,
+    ):
         """
         Initialize the agent loop.
 
         Args:
             api_key: Anthropic API key (defaults to ANTHROPIC_API_KEY environment variable)
             model: Model to use for the agent
+            client: Existing Anthropic client to reuse (created from api_key if omitted)
+            max_turns: Maximum number of user turns kept in the prompt history
+            parallel_tools: Run the tool calls of one response concurrently
         """
         self.api_key = api_key or os.environ.get("ANTHROPIC_API_KEY")
         if not self.api_key:
             raise ValueError("No API key provided")
 
         self.model = model
-        self.client = anthropic.Anthropic(api_key=self.api_key)
+        self.client = client or anthropic.Anthropic(api_key=self.api_key)
         
         # Initialize tools - only using screenshot capability
         self.computer_tool = ComputerTool()
@@ -54,7 +62,17 @@ class AgentLoop:
             self.computer_tool,
         ]
         
+        # The tool schema never changes during a session; build it once, in
+        # a stable order, so every request sends identical bytes
+        self.api_tools = sorted(self.get_api_tools(), key=lambda tool: tool["name"])
+        if self.api_tools:
+            self.api_tools[-1] = {**self.api_tools[-1], "cache_control": _CACHE_CONTROL}
+        
+        self.max_turns = max_turns
+        self.parallel_tools = parallel_tools
         self.messages: List[Dict[str, Any]] = []
+        self.last_response = ""
+        self.last_tool_calls: List[Dict[str, Any]] = []
         self.system_prompt = (
             "You are Claude, an AI assistant that can take screenshots of the computer. "
             "You have access to a 'computer' tool that has a 'screenshot' action. "
@@ -73,6 +91,24 @@ class AgentLoop:
         """
         self.messages.append(message)
 
+    def _trim_history(self) -> None:
+        """
+        Drop the oldest turns once more than max_turns user inputs are kept.
+
+        The history is cut back to half the window at once rather than by one
+        turn per request, so the message prefix stays byte-identical (and
+        cacheable) for several turns between trims. Trimming always starts at
+        a user input (not a tool result message), so a tool use is never
+        separated from its result.
+        """
+        user_indices = [
+            i for i, msg in enumerate(self.messages)
+            if msg["role"] == "user" and isinstance(msg["content"], str)
+        ]
+        if len(user_indices) > self.max_turns:
+            keep = max(1, self.max_turns // 2)
+            del self.messages[:user_indices[-keep]]
+
     def get_api_tools(self) -> List[Dict[str, Any]]:
         """
         Get the tools in the format expected by the Anthropic API.
@@ -94,133 +130,330 @@ class AgentLoop:
             })
         return api_tools
 
-    def run(self, user_input: str) -> Tuple[str, List[Dict[str, Any]]]:
+    def _prepare_request(self, user_input: str) -> Dict[str, Any]:
         """
-        Run the agent loop with the given user input.
+        Record the user input and build the arguments for the API call.
 
         Args:
             user_input: User input to process
 
         Returns:
-            Tuple of (agent response, tool calls made)
+            Keyword arguments for messages.create / messages.stream
         """
         # Add user message to history
         self.add_message({"role": "user", "content": user_input})
+        self._trim_history()
         
-        # Prepare messages for the API
-        api_messages = []
-        for msg in self.messages:
-            if "tool_calls" in msg and msg["tool_calls"]:
-                # Handle tool calls in assistant messages
-                api_messages.append({
-                    "role": msg["role"],
-                    "content": msg.get("content", ""),
-                    "tool_calls": msg["tool_calls"]
-                })
-            elif "tool_call" in msg and msg["tool_call"]:
-                # Handle tool responses
-                api_messages.append({
-                    "role": msg["role"],
-                    "content": msg.get("content", ""),
-                    "tool_call_id": msg["tool_call"]["id"],
-                })
-            else:
-                # Handle regular messages
-                api_messages.append({
-                    "role": msg["role"],
-                    "content": msg.get("content", "")
-                })
+        # History is stored in API format, so it only needs a shallow copy
+        api_messages = list(self.messages)
+
+        # Mark the end of the previous turn so the history up to it is served
+        # from the prompt cache
+        if len(api_messages) >= 2:
+            api_messages[-2] = _with_cache_control(api_messages[-2])
 
-        # Get tools for debugging
-        tools = self.get_api_tools()
-        print(f"Using model: {self.model}")
-        print(f"Available tools: {json.dumps(tools, indent=2)}")
+        logger.debug("Using model: %s", self.model)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Available tools: %s", json.dumps(self.api_tools, indent=2))
         
-        # Call the API
-        response = self.client.messages.create(
-            model=self.model,
-            system=self.system_prompt,
-            messages=api_messages,
-            tools=tools,
-            max_tokens=4096,
-        )
+        return {
+            "model": self.model,
+            "system": [{"type": "text", "text": self.system_prompt, "cache_control": _CACHE_CONTROL}],
+            "messages": api_messages,
+            "tools": self.api_tools,
+            "max_tokens": 4096,
+        }
+
+    def _execute_tool_call(self, block: Any) -> Dict[str, Any]:
+        """
+        Execute the tool requested by a tool_use block.
+
+        Args:
+            block: tool_use content block from the API response
+
+        Returns:
+            Result of the tool execution
+        """
+        logger.debug("Executing tool: %s with args: %s", block.name, block.input)
         
+        # Find the matching tool and execute it
+        for tool in self.tools:
+            if tool.name == block.name:
+                result = tool.execute(**block.input)
+                break
+        else:
+            # Every tool use needs a result, or the next request is rejected
+            result = {
+                "success": False,
+                "message": f"Unknown tool: {block.name}",
+            }
+        
+        logger.debug("Tool result: %s", result)
+        return result
+
+    def _process_response(self, response: Message) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        Execute any requested tools and record the assistant response.
+
+        Args:
+            response: Complete message returned by the API
+
+        Returns:
+            Tuple of (agent response, tool calls made)
+        """
         # Log response for debugging
-        print(f"Raw response: {response}")
+        logger.debug("Raw response: %s", response)
         
         # Process the response
         tool_calls = []
         user_facing_content = ""
+        assistant_content = []
+        tool_blocks = []
         
         # The new API returns tool use blocks in the content
-        if hasattr(response, 'content') and isinstance(response.content, list):
-            for block in response.content:
+        content = getattr(response, "content", None)
+        if isinstance(content, list):
+            # First pass: collect text and the requested tool uses
+            for block in content:
                 if block.type == 'text':
-                    # Remove thinking tags if present
-                    text = block.text
-                    if "<thinking>" in text and "</thinking>" in text:
-                        parts = text.split("</thinking>")
-                        if len(parts) > 1:
-                            text = parts[1].strip()
-                        else:
-                            text = ""
+                    # Remove thinking sections, using the same rule as the stream
+                    text = "".join(_strip_thinking([block.text])).strip()
                     user_facing_content += text
+                    if text:
+                        assistant_content.append({"type": "text", "text": text})
                 elif block.type == 'tool_use':
-                    print(f"Tool use block found: {block}")
-                    tool_name = block.name
-                    tool_args = block.input
-                    tool_id = block.id
-                    
-                    print(f"Executing tool: {tool_name} with args: {tool_args}")
-                    
-                    # Find the matching tool
-                    for tool in self.tools:
-                        if tool.name == tool_name:
-                            # Execute the tool
-                            result = tool.execute(**tool_args)
-                            
-                            print(f"Tool result: {result}")
-                            
-                            # Record the tool call
-                            tool_call = {
-                                "id": tool_id,
-                                "name": tool_name,
-                                "args": tool_args,
-                                "result": result
-                            }
-                            tool_calls.append(tool_call)
-                            
-                            # Add tool call to messages
-                            self.add_message({
-                                "role": "assistant",
-                                "content": "",
-                                "tool_calls": [{
-                                    "id": tool_id,
-                                    "name": tool_name,
-                                    "args": tool_args
-                                }]
-                            })
-                            
-                            # Add tool response to messages
-                            self.add_message({
-                                "role": "tool",
-                                "content": str(result),
-                                "tool_call": {
-                                    "id": tool_id,
-                                    "name": tool_name
-                                }
-                            })
-                            
-                            break
+                    logger.debug("Tool use block found: %s", block)
+                    assistant_content.append({
+                        "type": "tool_use",
+                        "id": block.id,
+                        "name": block.name,
+                        "input": block.input,
+                    })
+                    tool_blocks.append(block)
         else:
             # Fall back to old approach if content is not structured as expected
-            user_facing_content = response.content[0].text if hasattr(response.content, '__iter__') else response.content
-            print("No tool use blocks found in response")
+            user_facing_content = content[0].text if isinstance(content, (list, tuple)) else content
+            logger.debug("No tool use blocks found in response")
+            if user_facing_content:
+                assistant_content.append({"type": "text", "text": user_facing_content})
+        
+        # Second pass: execute the tools, keeping results in request order.
+        # Identical read-only calls repeated within one response run only once
+        keys = [
+            (block.name, json.dumps(block.input, sort_keys=True, default=str))
+            if (block.name, block.input.get("action")) in _SAFE_TO_DEDUP
+            else block.id
+            for block in tool_blocks
+        ]
+        unique: Dict[Any, Any] = {}
+        for key, block in zip(keys, tool_blocks):
+            if key in unique:
+                logger.debug("Reusing result for repeated tool call: %s", block.name)
+            else:
+                unique[key] = block
+        
+        # Tools are mostly I/O bound, so independent calls run in threads and
+        # the turn waits for the slowest tool rather than the sum of them all
+        if self.parallel_tools and len(unique) > 1:
+            with ThreadPoolExecutor(max_workers=min(_MAX_TOOL_WORKERS, len(unique))) as executor:
+                outputs = list(executor.map(self._execute_tool_call, unique.values()))
+        else:
+            outputs = [self._execute_tool_call(block) for block in unique.values()]
+        executed = dict(zip(unique, outputs))
+        results = [executed[key] for key in keys]
+        
+        # Third pass: record each call and build the matching tool results.
+        # A repeated call is marked with the id of the call that actually ran
+        tool_results = []
+        first_ids: Dict[Any, str] = {}
+        for key, block, result in zip(keys, tool_blocks, results):
+            call = {
+                "id": block.id,
+                "name": block.name,
+                "args": block.input,
+                "result": result
+            }
+            if key in first_ids:
+                call["duplicate_of"] = first_ids[key]
+            else:
+                first_ids[key] = block.id
+            tool_calls.append(call)
+            tool_results.append({
+                "type": "tool_result",
+                "tool_use_id": block.id,
+                "content": serialize_result(result),
+                "is_error": not result.get("success", True),
+            })
+        
+        # Add the assistant response, followed by the results of any tool uses
+        if assistant_content:
+            self.add_message({"role": "assistant", "content": assistant_content})
+        if tool_results:
+            self.add_message({"role": "user", "content": tool_results})
+        
+        return user_facing_content, tool_calls
+
+    def run(self, user_input: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        Run the agent loop with the given user input.
+
+        Args:
+            user_input: User input to process
+
+        Returns:
+            Tuple of (agent response, tool calls made)
+        """
+        request = self._prepare_request(user_input)
         
-        # Add assistant response to messages
-        self.add_message({
-            "role": "assistant",
-            "content": user_facing_content
-        })
+        # Call the API
+        response = self.client.messages.create(**request)
         
-        return user_facing_content, tool_calls
\ No newline at end of file
+        self.last_response, self.last_tool_calls = self._process_response(response)
+        return self.last_response, self.last_tool_calls
+
+    def run_stream(self, user_input: str) -> Iterator[str]:
+        """
+        Run the agent loop, yielding response text as it is generated.
+
+        Tools are executed once the stream completes. The final response
+        and tool calls are then available as last_response and
+        last_tool_calls.
+
+        Args:
+            user_input: User input to process
+
+        Yields:
+            Chunks of response text
+        """
+        request = self._prepare_request(user_input)
+        
+        # Stream the API response
+        with self.client.messages.stream(**request) as stream:
+            yield from _strip_thinking(_text_deltas(stream))
+            response = stream.get_final_message()
+        
+        self.last_response, self.last_tool_calls = self._process_response(response)
+
+
+def _with_cache_control(message: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return a copy of a message with a cache breakpoint on its last block.
+
+    The stored history is left untouched; string content is converted to a
+    single text block since only blocks can carry cache_control.
+
+    Args:
+        message: API message to mark
+
+    Returns:
+        Marked copy of the message, or the message itself if it has no content
+    """
+    content = message.get("content")
+    if not content:
+        return message
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = list(content)
+    content[-1] = {**content[-1], "cache_control": _CACHE_CONTROL}
+    return {**message, "content": content}
+
+
+def serialize_result(result: Any) -> str:
+    """
+    Serialize a tool result for the prompt history and the chat log.
+
+    Screenshot image bytes are left out; they are returned to the caller
+    for display but are not useful to the model as text.
+
+    Args:
+        result: Tool result to serialize
+
+    Returns:
+        Compact JSON representation of the result
+    """
+    if isinstance(result, dict) and "screenshot" in result:
+        result = {key: value for key, value in result.items() if key != "screenshot"}
+    return json.dumps(result, separators=(",", ":"), default=str)
+
+
+def _text_deltas(events: Iterable[Any]) -> Iterator[Optional[str]]:
+    """
+    Pick the text out of a stream of API events.
+
+    Args:
+        events: Events from messages.stream
+
+    Yields:
+        Text chunks, with None marking the end of each content block
+    """
+    for event in events:
+        if event.type == "content_block_delta" and event.delta.type == "text_delta":
+            yield event.delta.text
+        elif event.type == "content_block_stop":
+            yield None
+
+
+def _strip_thinking(chunks: Iterable[Optional[str]]) -> Iterator[str]:
+    """
+    Remove <thinking>...</thinking> sections from text as it arrives.
+
+    Text around a section is kept, and whitespace following it is dropped.
+    A section that is never closed within its content block is kept as-is.
+    _process_response runs each text block through this as well, so the
+    streamed reply and the recorded one match.
+
+    Args:
+        chunks: Text chunks, with None marking the end of a content block
+
+    Yields:
+        Text chunks with the thinking sections removed
+    """
+    pending = ""
+    inside = False
+    skip_space = False
+    for chunk in chunks:
+        if chunk is None:
+            # End of the content block: flush whatever is still held back
+            if pending or inside:
+                yield ("<thinking>" if inside else "") + pending
+            pending, inside, skip_space = "", False, False
+            continue
+        
+        pending += chunk
+        if skip_space:
+            pending = pending.lstrip()
+            if not pending:
+                continue
+            skip_space = False
+        
+        while True:
+            if inside:
+                end = pending.find("</thinking>")
+                if end == -1:
+                    break
+                inside = False
+                pending = pending[end + len("</thinking>"):].lstrip()
+                if not pending:
+                    skip_space = True
+                    break
+            else:
+                start = pending.find("<thinking>")
+                if start == -1:
+                    # Hold back a tail that could still become an opening tag
+                    keep = next(
+                        (n for n in range(min(len(pending), len("<thinking>") - 1), 0, -1)
+                         if "<thinking>".startswith(pending[-n:])),
+                        0,
+                    )
+                    if len(pending) > keep:
+                        yield pending[:len(pending) - keep]
+                        pending = pending[len(pending) - keep:]
+                    break
+                if start:
+                    yield pending[:start]
+                inside = True
+                pending = pending[start + len("<thinking>"):]
+    
+    if pending or inside:
+        yield ("<thinking>" if inside else "") + pending
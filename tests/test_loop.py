@@ -0,0 +1,147 @@
+"""
+Tests for AgentLoop response handling.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from loop import AgentLoop, _strip_thinking
+
+CASES = [
+    ("<thinking>plan</thinking>Sure", "Sure"),
+    ("<thinking>plan</thinking>\n\nSure", "Sure"),
+    ("Sure. <thinking>plan</thinking> Done", "Sure. Done"),
+    ("a<thinking>1</thinking>b<thinking>2</thinking>c", "abc"),
+    ("no tags, just a < sign", "no tags, just a < sign"),
+]
+
+
+class FakeStream:
+    """
+    Stand-in for the SDK's MessageStream, replaying text deltas as events.
+    """
+
+    def __init__(self, deltas, message):
+        self.deltas = deltas
+        self.message = message
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __iter__(self):
+        for text in self.deltas:
+            yield SimpleNamespace(
+                type="content_block_delta",
+                delta=SimpleNamespace(type="text_delta", text=text),
+            )
+        yield SimpleNamespace(type="content_block_stop")
+
+    def get_final_message(self):
+        return self.message
+
+
+class FakeMessages:
+    """
+    Stand-in for client.messages returning a single text block.
+    """
+
+    def __init__(self, deltas):
+        self.deltas = deltas
+        text = "".join(deltas)
+        self.message = SimpleNamespace(content=[SimpleNamespace(type="text", text=text)])
+
+    def create(self, **kwargs):
+        return self.message
+
+    def stream(self, **kwargs):
+        return FakeStream(self.deltas, self.message)
+
+
+def make_agent(deltas):
+    client = SimpleNamespace(messages=FakeMessages(deltas))
+    return AgentLoop(api_key="test", client=client)
+
+
+def splits(text):
+    """
+    Yield the text cut into two deltas at every offset.
+    """
+    for i in range(len(text) + 1):
+        yield [text[:i], text[i:]]
+
+
+@pytest.mark.parametrize("text,expected", CASES)
+def test_stream_matches_recorded_at_every_split(text, expected):
+    for deltas in splits(text):
+        agent = make_agent(deltas)
+        streamed = "".join(agent.run_stream("hi"))
+        assert streamed == expected, deltas
+        assert agent.last_response == expected, deltas
+
+
+@pytest.mark.parametrize("text,expected", CASES)
+def test_filter_handles_one_character_deltas(text, expected):
+    assert "".join(_strip_thinking(list(text))) == expected
+
+
+def test_unterminated_tag_is_kept_at_end_of_stream():
+    text = "Hi <thinking>never closed"
+    for deltas in splits(text):
+        agent = make_agent(deltas)
+        streamed = "".join(agent.run_stream("hi"))
+        assert streamed == text, deltas
+        assert agent.last_response == text, deltas
+
+
+def test_unterminated_tag_does_not_leak_into_next_block():
+    chunks = ["<thinking>a", None, "b<thin", "king>z</thinking>c", None]
+    assert "".join(_strip_thinking(chunks)) == "<thinking>abc"
+
+
+def test_run_sets_last_response():
+    agent = make_agent(["<thinking>plan</thinking>Sure"])
+    agent.last_response = "stale"
+    agent.last_tool_calls = [{"name": "stale"}]
+    assert agent.run("hi") == ("Sure", [])
+    assert agent.last_response == "Sure"
+    assert agent.last_tool_calls == []
+
+
+class CountingTool:
+    """
+    Tool stub that counts how often it runs.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+
+    def execute(self, **kwargs):
+        self.calls += 1
+        return {"success": True}
+
+
+def tool_use(block_id, name, **tool_input):
+    return SimpleNamespace(type="tool_use", id=block_id, name=name, input=tool_input)
+
+
+def test_only_read_only_calls_are_deduplicated():
+    agent = make_agent([])
+    screenshot, bash = CountingTool("computer"), CountingTool("bash")
+    agent.tools = [screenshot, bash]
+    response = SimpleNamespace(content=[
+        tool_use("a", "computer", action="screenshot"),
+        tool_use("b", "computer", action="screenshot"),
+        tool_use("c", "bash", command="echo x >> f"),
+        tool_use("d", "bash", command="echo x >> f"),
+    ])
+
+    _, tool_calls = agent._process_response(response)
+
+    assert (screenshot.calls, bash.calls) == (1, 2)
+    assert [call.get("duplicate_of") for call in tool_calls] == [None, "a", None, None]
+    tool_results = agent.messages[-1]["content"]
+    assert [block["tool_use_id"] for block in tool_results] == ["a", "b", "c", "d"]
@@ -1,9 +1,9 @@
 """
 Computer tool implementation.
 """
-import base64
 import io
 import json
+import logging
 import os
 import platform
 from typing import Any, Dict, List, Optional, Tuple, Union
@@ -13,6 +13,8 @@ from PIL import Image, ImageGrab
 
 from tools.base import Tool
 
+logger = logging.getLogger(__name__)
+
 
 class ComputerTool(Tool):
     """
@@ -61,32 +63,29 @@ class ComputerTool(Tool):
                 new_height = int(original_height * scale_factor)
                 screenshot = screenshot.resize((new_width, new_height), Image.LANCZOS)
             
-            # Convert to base64 for transmission
+            # Encode as PNG; callers get the raw bytes and only base64-encode
+            # them if they actually need a text representation
             buffered = io.BytesIO()
-            screenshot.save(buffered, format="PNG", optimize=True, quality=85)
+            # optimize=True makes Pillow search zlib settings for a few percent
+            # smaller files at several times the encode cost; not worth it here
+            screenshot.save(buffered, format="PNG")
             img_bytes = buffered.getvalue()
-            img_str = base64.b64encode(img_bytes).decode()
             
             # Get screen dimensions
             width, height = screenshot.size
             
-            # Debug info
-            img_size = len(img_bytes)
-            b64_size = len(img_str)
-            
             return {
                 "success": True,
                 "width": width,
                 "height": height,
-                "screenshot": f"data:image/png;base64,{img_str}",
-                "message": f"Screenshot taken successfully. Image size: {img_size} bytes, Base64 size: {b64_size} bytes",
+                "screenshot": img_bytes,
+                "message": f"Screenshot taken successfully. Image size: {len(img_bytes)} bytes",
             }
         except Exception as e:
-            import traceback
-            error_trace = traceback.format_exc()
+            logger.exception("Failed to take screenshot")
             return {
                 "success": False,
-                "message": f"Failed to take screenshot: {str(e)}\n{error_trace}",
+                "message": f"Failed to take screenshot: {str(e)}",
             }
             
     def execute(self, action: str, x: Optional[int] = None, y: Optional[int] = None, text: Optional[str] = None) -> Dict[str, Any]: